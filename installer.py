@@ -7,20 +7,32 @@ present and orchestrate build/start commands together with a Baileys service.
 from __future__ import annotations
 
 import argparse
+import asyncio
+import functools
+import json
 import logging
 import os
 import platform
 import shutil
+import signal
 import subprocess
 import sys
-import threading
+import warnings
 from pathlib import Path
-from typing import Iterable, List, Optional, Sequence, Tuple
+from typing import FrozenSet, Iterable, List, NoReturn, Optional, Sequence, Tuple
 
 
 DEFAULT_FRONTEND_PATH = "frontend"
 DEFAULT_PORT = 3002
 DEFAULT_BAILEYS_SCRIPT = "baileys-service.js"
+START_COMMAND = ("npm", "run", "start")
+BUILD_OUTPUT_DIRS = ("dist", "build", ".next")
+# Entradas do topo do front-end que não são fontes do build; data/ recebe as
+# credenciais e o catálogo de instâncias gravados pelo baileys-service.js.
+BUILD_IGNORED_ROOTS = frozenset({"node_modules", ".git", "data", *BUILD_OUTPUT_DIRS})
+NPM_LOCKFILES = ("package-lock.json", "npm-shrinkwrap.json")
+NPM_INSTALL_FLAGS = ("--no-audit", "--no-fund")
+STREAM_LIMIT = 2**16
 
 
 def parse_args() -> argparse.Namespace:
@@ -58,6 +70,14 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Ignora a execução de 'npm run build'.",
     )
+    parser.add_argument(
+        "--force-build",
+        action="store_true",
+        help=(
+            "Executa 'npm run build' mesmo quando a saída do build é mais recente "
+            "que os fontes."
+        ),
+    )
     parser.add_argument(
         "--skip-start",
         action="store_true",
@@ -84,14 +104,13 @@ def configure_logging(level: str) -> None:
     )
 
 
-def ensure_node_and_npm() -> None:
-    """Valida se Node.js e npm estão presentes na máquina."""
-    node_path = shutil.which("node")
-    npm_path = shutil.which("npm")
+@functools.lru_cache(maxsize=1)
+def _resolve_node_npm() -> Tuple[str, str]:
+    """Localiza Node.js e npm, priorizando as variáveis NODE e NPM."""
+    node_path = shutil.which(os.environ.get("NODE") or "node")
+    npm_path = shutil.which(os.environ.get("NPM") or "npm")
     if node_path and npm_path:
-        logging.info("Node.js localizado em %s", node_path)
-        logging.info("npm localizado em %s", npm_path)
-        return
+        return node_path, npm_path
 
     system_name = platform.system()
     install_instructions = {
@@ -113,25 +132,145 @@ def ensure_node_and_npm() -> None:
     )
 
 
+def ensure_node_and_npm() -> None:
+    """Valida se Node.js e npm estão presentes na máquina."""
+    node_path, npm_path = _resolve_node_npm()
+    logging.info("Node.js localizado em %s", node_path)
+    logging.info("npm localizado em %s", npm_path)
+
+
+class _LazyJoin:
+    """Adia o ``" ".join`` de um comando até o log ser de fato emitido."""
+
+    def __init__(self, parts: Sequence[str]) -> None:
+        self.parts = parts
+
+    def __str__(self) -> str:
+        return " ".join(self.parts)
+
+
+def _resolve_argv(command: Iterable[str]) -> List[str]:
+    """Troca 'node'/'npm' pelos caminhos absolutos já resolvidos."""
+    argv = list(command)
+    if argv and argv[0] in ("node", "npm"):
+        node_path, npm_path = _resolve_node_npm()
+        argv[0] = node_path if argv[0] == "node" else npm_path
+    return argv
+
+
 def run_command(command: Iterable[str], cwd: Optional[Path] = None) -> None:
-    display_cmd = " ".join(command)
+    command = list(command)
+    display_cmd = _LazyJoin(command)
     logging.info("Executando comando: %s (cwd=%s)", display_cmd, cwd or os.getcwd())
     try:
-        subprocess.run(command, cwd=cwd, check=True)
+        subprocess.run(_resolve_argv(command), cwd=cwd, check=True)
     except subprocess.CalledProcessError as exc:
         logging.error("Comando falhou com código %s: %s", exc.returncode, display_cmd)
         raise
 
 
-def ensure_dependency(frontend_path: Path, package: str) -> None:
-    logging.info("Garantindo dependência npm '%s'", package)
-    run_command(["npm", "install", package], cwd=frontend_path)
+def _installed(frontend_dir: str, package: str) -> bool:
+    try:
+        os.stat(os.path.join(frontend_dir, "node_modules", package, "package.json"))
+    except OSError:
+        return False
+    return True
+
+
+def _node_modules_current(frontend_path: Path) -> bool:
+    """Indica se o npm já sincronizou node_modules com os manifestos atuais."""
+    try:
+        installed_mtime = (
+            (frontend_path / "node_modules" / ".package-lock.json").stat().st_mtime
+        )
+    except OSError:
+        return False
+    for name in ("package.json", *NPM_LOCKFILES):
+        try:
+            if (frontend_path / name).stat().st_mtime > installed_mtime:
+                return False
+        except OSError:
+            continue
+    return True
+
+
+def _has_dependency(frontend_path: Path, package: str) -> bool:
+    """Indica se o pacote está declarado no package.json do front-end."""
+    try:
+        with (frontend_path / "package.json").open(encoding="utf-8") as handle:
+            manifest = json.load(handle)
+    except (OSError, ValueError):
+        return False
+    return any(
+        package in (manifest.get(section) or {})
+        for section in ("dependencies", "devDependencies")
+    )
 
 
 def install_dependencies(frontend_path: Path) -> None:
-    logging.info("Instalando dependências do front-end (npm install)")
-    run_command(["npm", "install"], cwd=frontend_path)
-    ensure_dependency(frontend_path, "baileys")
+    # A escolha entre ci/install depende só do que o package.json declara:
+    # 'npm ci' e 'npm install' removem de node_modules pacotes não declarados.
+    if not _has_dependency(frontend_path, "baileys"):
+        # Uma única resolução do grafo instala o manifesto e o pacote 'baileys';
+        # 'npm ci' não é usado aqui porque não adiciona pacotes ao lockfile.
+        logging.info("Instalando dependências do front-end e o pacote 'baileys'")
+        run_command(
+            ["npm", "install", "baileys", "--save", *NPM_INSTALL_FLAGS],
+            cwd=frontend_path,
+        )
+        return
+    if _installed(os.fspath(frontend_path), "baileys") and _node_modules_current(
+        frontend_path
+    ):
+        logging.info(
+            "Dependências do front-end já instaladas; npm não será executado."
+        )
+        return
+    has_lockfile = any((frontend_path / name).exists() for name in NPM_LOCKFILES)
+    install = "ci" if has_lockfile else "install"
+    logging.info("Instalando dependências do front-end (npm %s)", install)
+    run_command(["npm", install, *NPM_INSTALL_FLAGS], cwd=frontend_path)
+
+
+def _newest_mtime(root: str, exclude: FrozenSet[str] = frozenset()) -> float:
+    """Maior mtime sob ``root``; ``exclude`` vale só para as entradas do topo."""
+    newest = 0.0
+    try:
+        entries = os.scandir(root)
+    except OSError:
+        return newest
+    with entries:
+        for entry in entries:
+            if entry.name in exclude:
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    newest = max(newest, _newest_mtime(entry.path))
+                else:
+                    newest = max(newest, entry.stat(follow_symlinks=False).st_mtime)
+            except OSError:
+                continue
+    return newest
+
+
+def is_build_up_to_date(frontend_path: Path) -> bool:
+    """Indica se a saída do build é mais recente que os fontes do front-end."""
+    output_dir = next(
+        (
+            frontend_path / name
+            for name in BUILD_OUTPUT_DIRS
+            if (frontend_path / name).is_dir()
+        ),
+        None,
+    )
+    if output_dir is None:
+        return False
+    # Qualquer arquivo do projeto conta como fonte (public/, pages/, arquivos de
+    # configuração, manifestos...), exceto dependências, saídas de build e
+    # dados gravados em tempo de execução. Só o topo do projeto é filtrado:
+    # um src/build/ aninhado continua sendo fonte.
+    sources_mtime = _newest_mtime(os.fspath(frontend_path), BUILD_IGNORED_ROOTS)
+    return _newest_mtime(os.fspath(output_dir)) > sources_mtime
 
 
 def run_build(frontend_path: Path) -> None:
@@ -139,60 +278,233 @@ def run_build(frontend_path: Path) -> None:
     run_command(["npm", "run", "build"], cwd=frontend_path)
 
 
-def run_command_async(
+def install_child_watcher() -> None:
+    """Usa pidfds para acompanhar o término dos processos filhos.
+
+    Substitui os watchers padrão (``ThreadedChildWatcher``/``SafeChildWatcher``),
+    que criam uma thread por processo ou dependem de SIGCHLD. Em sistemas que
+    não sejam Linux 5.3+ o watcher padrão do asyncio é mantido.
+    """
+    if sys.platform != "linux" or not hasattr(asyncio, "PidfdChildWatcher"):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):
+        logging.debug("pidfd indisponível; mantendo watcher padrão do asyncio.")
+        return
+    watcher = asyncio.PidfdChildWatcher()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        asyncio.set_child_watcher(watcher)
+    watcher.attach_loop(asyncio.get_running_loop())
+    logging.debug("PidfdChildWatcher instalado para os processos filhos.")
+
+
+class _ServiceProtocol(asyncio.subprocess.SubprocessStreamProtocol):
+    """Sinaliza o término do líder sem esperar o fechamento dos pipes.
+
+    ``Process.wait()`` só retorna depois que stdout/stderr fecham, o que não
+    acontece enquanto processos netos (npm → node) mantêm os pipes herdados.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        super().__init__(limit=STREAM_LIMIT, loop=loop)
+        self.exited: asyncio.Future[None] = loop.create_future()
+
+    def process_exited(self) -> None:
+        super().process_exited()
+        if not self.exited.done():
+            self.exited.set_result(None)
+
+
+async def _pump(
+    stream: Optional[asyncio.StreamReader], prefix: str, level: int
+) -> None:
+    if stream is None:
+        return
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            logging.warning(
+                "%s linha excedeu o limite do buffer e foi descartada.", prefix
+            )
+            continue
+        if not line:
+            break
+        logging.log(level, "%s %s", prefix, line.decode(errors="replace").rstrip())
+
+
+def _signal_group(process: asyncio.subprocess.Process, sig: int) -> None:
+    """Envia o sinal ao grupo do processo, alcançando também os netos."""
+    if os.name != "posix":
+        if sig == signal.SIGTERM:
+            process.terminate()
+        else:
+            process.kill()
+        return
+    try:
+        # Com start_new_session=True o PID do filho é também o ID do grupo, que
+        # continua válido mesmo depois que o líder já foi coletado.
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def _group_alive(process: asyncio.subprocess.Process) -> bool:
+    if os.name != "posix":
+        return False
+    try:
+        os.killpg(process.pid, 0)
+    except (ProcessLookupError, PermissionError):
+        return False
+    return True
+
+
+async def _wait_group(process: asyncio.subprocess.Process, timeout: float) -> bool:
+    """Aguarda até que nenhum processo do grupo continue em execução."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while _group_alive(process):
+        if loop.time() >= deadline:
+            return False
+        await asyncio.sleep(0.1)
+    return True
+
+
+async def _terminate(
+    process: asyncio.subprocess.Process, exited: asyncio.Future[None]
+) -> None:
+    # Espera pelo futuro de término do líder (_ServiceProtocol.exited), não por
+    # process.wait(), que também aguarda pipes mantidos por processos destacados.
+    if not exited.done():
+        logging.info("Enviando sinal de término para o grupo do PID %s", process.pid)
+        _signal_group(process, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.shield(exited), timeout=5)
+        except asyncio.TimeoutError:
+            logging.warning(
+                "Processo PID %s não encerrou após SIGTERM. Enviando SIGKILL ao grupo.",
+                process.pid,
+            )
+            _signal_group(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+            await asyncio.shield(exited)
+
+    # O líder já foi coletado, mas netos (npm → node) podem continuar no grupo
+    # segurando a porta; o ID do grupo segue válido enquanto houver membros.
+    if not _group_alive(process):
+        return
+    logging.info("Encerrando processos remanescentes do grupo do PID %s", process.pid)
+    _signal_group(process, signal.SIGTERM)
+    if await _wait_group(process, timeout=5):
+        return
+    logging.warning(
+        "Processos do grupo do PID %s não encerraram após SIGTERM. Enviando SIGKILL.",
+        process.pid,
+    )
+    _signal_group(process, signal.SIGKILL)
+    await _wait_group(process, timeout=1)
+
+
+async def _spawn(
     command: Sequence[str],
-    processes: List[subprocess.Popen],
-    cwd: Optional[Path] = None,
+    prefix: str,
+    cwd: Optional[str] = None,
     env: Optional[dict[str, str]] = None,
 ) -> None:
-    display_cmd = " ".join(command)
+    display_cmd = _LazyJoin(command)
     logging.info(
         "Executando comando assíncrono: %s (cwd=%s)", display_cmd, cwd or os.getcwd()
     )
-    process = subprocess.Popen(command, cwd=cwd, env=env)
-    processes.append(process)
-    returncode = process.wait()
-    if returncode != 0:
-        raise subprocess.CalledProcessError(returncode, command)
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.subprocess_exec(
+        lambda: _ServiceProtocol(loop),
+        *_resolve_argv(command),
+        cwd=cwd,
+        env=env,
+        stdin=None,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    process = asyncio.subprocess.Process(transport, protocol, loop)
+    output = asyncio.gather(
+        _pump(process.stdout, prefix, logging.INFO),
+        _pump(process.stderr, prefix, logging.WARNING),
+    )
+    try:
+        await asyncio.shield(protocol.exited)
+    finally:
+        # Cada tarefa encerra o próprio grupo de processos, tanto ao ser
+        # cancelada quanto quando o líder termina sozinho; ao cancelar várias
+        # tarefas o tempo total de desligamento fica limitado ao maior timeout.
+        await _terminate(process, protocol.exited)
+        # Com o grupo encerrado os pipes fecham em seguida; só um processo que
+        # saiu do grupo (detached) os manteria abertos indefinidamente.
+        try:
+            await asyncio.wait_for(output, timeout=1)
+        except asyncio.TimeoutError:
+            logging.debug(
+                "%s saída ainda aberta após o término do processo.", prefix
+            )
+        transport.close()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, list(command))
+
+
+def exec_service(
+    command: Sequence[str], cwd: str, env: Optional[dict[str, str]] = None
+) -> NoReturn:
+    """Substitui o processo do installer pelo único serviço restante."""
+    logging.info(
+        "Substituindo o installer pelo comando: %s (cwd=%s)", _LazyJoin(command), cwd
+    )
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+    argv = _resolve_argv(command)
+    try:
+        os.chdir(cwd)
+        os.execvpe(argv[0], argv, env if env is not None else os.environ)
+    except OSError as exc:
+        logging.error(
+            "Comando '%s' terminou com exceção: %s", _LazyJoin(command), exc
+        )
+        raise SystemExit(1)
 
 
-def run_start(frontend_path: Path, processes: List[subprocess.Popen]) -> None:
+async def run_start(frontend_dir: str) -> None:
     logging.info("Iniciando front-end (npm run start)")
-    run_command_async(["npm", "run", "start"], processes, cwd=frontend_path)
+    await _spawn(START_COMMAND, "[frontend]", cwd=frontend_dir)
 
 
-def get_baileys_command(args: argparse.Namespace, frontend_path: Path) -> List[str]:
+def get_baileys_command(args: argparse.Namespace, frontend_dir: str) -> List[str]:
     if args.baileys_command:
         return args.baileys_command
-    script_path = frontend_path / DEFAULT_BAILEYS_SCRIPT
-    if not script_path.exists():
-        logging.warning(
-            "Script padrão '%s' não encontrado em %s. Crie-o ou forneça "
-            "--baileys-command.",
-            DEFAULT_BAILEYS_SCRIPT,
-            frontend_path,
-        )
-    return ["node", str(script_path)]
+    return ["node", os.path.join(frontend_dir, DEFAULT_BAILEYS_SCRIPT)]
 
 
-def run_baileys_service(
-    args: argparse.Namespace,
-    frontend_path: Path,
-    processes: List[subprocess.Popen],
-) -> None:
+def get_baileys_env(args: argparse.Namespace) -> dict[str, str]:
     env = os.environ.copy()
     env["BAILEYS_PORT"] = str(args.port)
-    command = get_baileys_command(args, frontend_path)
+    return env
+
+
+async def run_baileys_service(
+    args: argparse.Namespace,
+    frontend_dir: str,
+) -> None:
+    env = get_baileys_env(args)
+    command = get_baileys_command(args, frontend_dir)
     baileys_port = env["BAILEYS_PORT"]
     logging.info(
         "Iniciando serviço Baileys com BAILEYS_PORT=%s e comando: %s",
         baileys_port,
-        " ".join(command),
+        _LazyJoin(command),
     )
-    run_command_async(command, processes, cwd=frontend_path, env=env)
+    await _spawn(command, "[baileys]", cwd=frontend_dir, env=env)
 
 
-def main() -> None:
+async def main() -> None:
     args = parse_args()
     configure_logging(args.log_level)
 
@@ -210,92 +522,103 @@ def main() -> None:
             "Caminho do front-end inválido. Ajuste o parâmetro --frontend-path conforme a documentação."
         )
 
-    ensure_node_and_npm()
-    install_dependencies(frontend_path)
+    install_child_watcher()
 
-    threads: List[threading.Thread] = []
-    processes: List[subprocess.Popen] = []
-    thread_errors: List[Tuple[str, BaseException]] = []
-    errors_lock = threading.Lock()
-
-    def cleanup_processes() -> None:
-        for process in processes:
-            if process.poll() is None:
-                logging.info("Enviando sinal de término para PID %s", process.pid)
-                process.terminate()
-        for process in processes:
-            if process.poll() is None:
-                try:
-                    process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    logging.warning(
-                        "Processo PID %s não encerrou após terminate(). Enviando kill().",
-                        process.pid,
-                    )
-                    process.kill()
+    ensure_node_and_npm()
 
-    def thread_wrapper(name: str, target, *target_args) -> threading.Thread:
-        def _run() -> None:
-            try:
-                target(*target_args, processes)
-            except BaseException as exc:  # noqa: BLE001
-                logging.exception("Thread '%s' terminou com erro.", name)
-                with errors_lock:
-                    thread_errors.append((name, exc))
+    frontend_dir = os.fspath(frontend_path)
+    if (
+        not args.skip_baileys
+        and not args.baileys_command
+        and not os.path.isfile(os.path.join(frontend_dir, DEFAULT_BAILEYS_SCRIPT))
+    ):
+        logging.error(
+            "Script padrão '%s' não encontrado em %s.",
+            DEFAULT_BAILEYS_SCRIPT,
+            frontend_dir,
+        )
+        raise SystemExit(
+            "Crie o script, forneça --baileys-command ou use --skip-baileys."
+        )
 
-        return threading.Thread(target=_run, name=name)
+    install_dependencies(frontend_path)
+    tasks: List[asyncio.Task] = []
 
-    if not args.skip_build:
-        run_build(frontend_path)
-    else:
+    if args.skip_build:
         logging.info("Build do front-end foi pulado pelo usuário.")
-
-    if not args.skip_start:
-        threads.append(thread_wrapper("frontend-start", run_start, frontend_path))
+    elif not args.force_build and is_build_up_to_date(frontend_path):
+        logging.info(
+            "Build do front-end já está atualizado; use --force-build para refazê-lo."
+        )
     else:
-        logging.info("Inicialização do front-end foi pulada pelo usuário.")
+        run_build(frontend_path)
 
-    if not args.skip_baileys:
-        threads.append(
-            thread_wrapper("baileys-service", run_baileys_service, args, frontend_path)
+    if os.name == "posix" and args.skip_start != args.skip_baileys:
+        if not args.skip_start:
+            logging.info("Inicialização do serviço Baileys foi pulada pelo usuário.")
+            exec_service(START_COMMAND, frontend_dir)
+        logging.info("Inicialização do front-end foi pulada pelo usuário.")
+        exec_service(
+            get_baileys_command(args, frontend_dir),
+            frontend_dir,
+            get_baileys_env(args),
         )
-    else:
-        logging.info("Inicialização do serviço Baileys foi pulada pelo usuário.")
 
-    for thread in threads:
-        thread.start()
+    if os.name == "posix":
+        # Em sessões próprias os serviços não recebem o SIGHUP do terminal;
+        # cancelar a tarefa principal encerra os grupos como no Ctrl+C.
+        loop = asyncio.get_running_loop()
+        main_task = asyncio.current_task()
+        for sig in (signal.SIGTERM, signal.SIGHUP):
+            loop.add_signal_handler(sig, main_task.cancel)
 
     try:
-        while threads:
-            for thread in list(threads):
-                thread.join(timeout=0.2)
-                if not thread.is_alive():
-                    threads.remove(thread)
-            with errors_lock:
-                if thread_errors:
-                    break
-    except KeyboardInterrupt:
-        logging.warning("Execução interrompida pelo usuário. Encerrando serviços.")
-        cleanup_processes()
-        raise SystemExit(1)
-
-    with errors_lock:
-        recorded_errors = list(thread_errors)
+        # TaskGroup cancela os demais serviços assim que um deles falha; cada
+        # tarefa cancelada encerra o próprio processo antes de terminar.
+        async with asyncio.TaskGroup() as group:
+            if not args.skip_start:
+                tasks.append(
+                    group.create_task(run_start(frontend_dir), name="frontend-start")
+                )
+            else:
+                logging.info("Inicialização do front-end foi pulada pelo usuário.")
 
-    if recorded_errors:
-        for name, exc in recorded_errors:
+            if not args.skip_baileys:
+                tasks.append(
+                    group.create_task(
+                        run_baileys_service(args, frontend_dir),
+                        name="baileys-service",
+                    )
+                )
+            else:
+                logging.info(
+                    "Inicialização do serviço Baileys foi pulada pelo usuário."
+                )
+    except asyncio.CancelledError:
+        logging.warning("Execução interrompida pelo usuário. Serviços encerrados.")
+        raise SystemExit(1)
+    except ExceptionGroup:
+        for task in tasks:
+            if task.cancelled() or task.exception() is None:
+                continue
+            exc = task.exception()
             if isinstance(exc, subprocess.CalledProcessError):
                 logging.error(
-                    "Comando no thread '%s' falhou com código %s.", name, exc.returncode
+                    "Comando na tarefa '%s' falhou com código %s.",
+                    task.get_name(),
+                    exc.returncode,
                 )
             else:
-                logging.error("Thread '%s' terminou com exceção: %s", name, exc)
-        cleanup_processes()
+                logging.error(
+                    "Tarefa '%s' terminou com exceção: %s", task.get_name(), exc
+                )
         raise SystemExit(1)
 
 
 if __name__ == "__main__":
+    if sys.version_info < (3, 11):
+        sys.exit("O installer requer Python 3.11 ou superior.")
     try:
-        main()
+        asyncio.run(main())
     except subprocess.CalledProcessError:
         sys.exit(1)